@@ -1,42 +1,272 @@
 import argparse
+import contextlib
+import fcntl
+import fnmatch
 import getpass
+import hashlib
+import io
+import ipaddress
+import itertools
+import json
+import logging
 import paramiko
 import yaml
 import os
+import select
+import shlex
+import shutil
+import socket
 import sys
+import tempfile
+import threading
 import time
 import subprocess
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
+from paramiko.auth_strategy import AuthStrategy, InMemoryPrivateKey, Password
 from cryptography.hazmat.primitives.asymmetric import ed25519
 from cryptography.hazmat.primitives import serialization
 
+# Output kept in memory per stream before spilling to a temporary file
+DEFAULT_MAX_MEMORY = 1024 * 1024
+# Bytes read from the channel per recv() call
+RECV_CHUNK_SIZE = 32768
+
+# Authentication methods a Pi can list in `auth_order`, and the default order
+AUTH_METHODS = ("publickey", "password", "agent")
+DEFAULT_AUTH_ORDER = ["publickey", "password", "agent"]
+# Tried for "publickey" when a Pi has no key configured
+DEFAULT_KEY_NAMES = ("id_ed25519", "id_ecdsa", "id_rsa")
+
+# Characters that can chain or redirect commands; never cached
+CACHE_UNSAFE_CHARS = ";|&$`><()\n\r"
+
+# Hosts checked at once by fan-out commands
+DEFAULT_PARALLEL = 16
+# Addresses probed at once by `discover`
+DEFAULT_DISCOVER_PARALLEL = 64
+# Largest network `discover` will scan (an IPv4 /16)
+MAX_DISCOVER_ADDRESSES = 65536
+# Log channel for discovery probes; failed handshakes are expected while
+# scanning and are reported in the results instead of as paramiko tracebacks
+PROBE_LOG_CHANNEL = "pi_shell_tool.discover"
+logging.getLogger(PROBE_LOG_CHANNEL).addHandler(logging.NullHandler())
+
+# Parsed private keys, keyed by (path, mtime, passphrase), shared by every connection
+_key_cache = {}
+# Last auth method that worked per user@host, persisted between runs
+_auth_state = None
+_auth_state_lock = threading.Lock()
+
+
+def load_private_key(path, passphrase=None):
+    """Load and cache a private key, returning None if it can't be parsed."""
+    path = os.path.expanduser(str(path))
+    try:
+        cache_key = (path, os.stat(path).st_mtime, passphrase)
+    except OSError:
+        return None
+    if cache_key not in _key_cache:
+        pkey = None
+        try:
+            pkey = paramiko.PKey.from_path(path)
+        except (paramiko.PasswordRequiredException, TypeError):
+            # Encrypted key (cryptography raises TypeError for some formats).
+            # Like paramiko's key_filename handling, try the password as passphrase
+            if passphrase:
+                try:
+                    pkey = paramiko.PKey.from_path(path, passphrase.encode())
+                except (
+                    paramiko.SSHException,
+                    paramiko.UnknownKeyType,
+                    ValueError,
+                    TypeError,
+                    OSError,
+                ):
+                    pass
+        except (paramiko.SSHException, paramiko.UnknownKeyType, ValueError, OSError):
+            pass
+        _key_cache[cache_key] = pkey
+    return _key_cache[cache_key]
+
+
+def get_auth_state_path():
+    return Path.home() / ".config" / "pi-shell" / "auth_state.yml"
+
+
+def read_auth_state():
+    try:
+        with open(get_auth_state_path(), "r") as f:
+            state = yaml.safe_load(f)
+    except (OSError, yaml.YAMLError):
+        return {}
+    return state if isinstance(state, dict) else {}
+
+
+def get_remembered_auth(user, host):
+    global _auth_state
+    with _auth_state_lock:
+        if _auth_state is None:
+            _auth_state = read_auth_state()
+        return _auth_state.get(f"{user}@{host}")
+
+
+def remember_auth(user, host, method):
+    global _auth_state
+    if get_remembered_auth(user, host) == method:
+        return
+    with _auth_state_lock:
+        try:
+            state_path = get_auth_state_path()
+            state_path.parent.mkdir(parents=True, exist_ok=True)
+            # Other processes update the file too: merge under a lock and
+            # replace it atomically so readers never see a partial write
+            with open(state_path.with_suffix(".lock"), "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                _auth_state = read_auth_state()
+                _auth_state[f"{user}@{host}"] = method
+                tmp_path = state_path.with_suffix(f".{os.getpid()}.tmp")
+                with open(tmp_path, "w") as f:
+                    yaml.dump(_auth_state, f, default_flow_style=False)
+                os.replace(tmp_path, state_path)
+        except OSError:
+            pass  # Only an optimization; the next run just tries the full order
+
+
+class PiAuthStrategy(AuthStrategy):
+    """
+    Try auth methods in an explicit order, starting with the one that worked
+    last time for this user@host. Sources are built lazily, so a method that
+    is never reached costs nothing (not even a call to the agent).
+    """
+
+    def __init__(self, user, host, password=None, key_filename=None, order=None):
+        super().__init__(ssh_config=paramiko.SSHConfig())
+        self.user = user
+        self.host = host
+        self.password = password
+        self.key_filename = key_filename
+        self.order = [m for m in (order or DEFAULT_AUTH_ORDER) if m in AUTH_METHODS]
+        self._methods = {}
+        self._agents = []
+
+    def get_sources(self):
+        order = list(self.order)
+        remembered = get_remembered_auth(self.user, self.host)
+        if remembered in order:
+            order.remove(remembered)
+            order.insert(0, remembered)
+
+        for method in order:
+            for source in self._sources_for(method):
+                self._methods[source] = method
+                yield source
+
+    def _sources_for(self, method):
+        if method == "publickey":
+            if self.key_filename:
+                paths = [self.key_filename]
+            else:
+                ssh_dir = Path.home() / ".ssh"
+                paths = [ssh_dir / name for name in DEFAULT_KEY_NAMES]
+            for path in paths:
+                pkey = load_private_key(path, self.password)
+                if pkey:
+                    yield InMemoryPrivateKey(self.user, pkey)
+        elif method == "password":
+            if self.password:
+                yield Password(self.user, lambda: self.password)
+        elif method == "agent":
+            try:
+                agent = paramiko.Agent()
+            except paramiko.SSHException:
+                return
+            # Agent keys sign through this connection, so it is closed at the
+            # end of authenticate() rather than here
+            self._agents.append(agent)
+            for pkey in agent.get_keys():
+                yield InMemoryPrivateKey(self.user, pkey)
+
+    def authenticate(self, transport):
+        try:
+            result = super().authenticate(transport)
+        finally:
+            for agent in self._agents:
+                agent.close()
+            self._agents = []
+        remember_auth(self.user, self.host, self._methods[result[-1].source])
+        return result
+
+
+def sudo_shell_path(path):
+    """
+    Quote a remote path for the script run by upload_file_sudo(), expanding a
+    leading ~ to the SSH user's home, which that script receives as $1.
+    """
+    if path == "~":
+        return '"$1"'
+    if path.startswith("~/"):
+        return '"$1"/' + shlex.quote(path[2:])
+    return shlex.quote(path)
+
 
 class PiBridge:
-    def __init__(self, host, user="pi", password=None, key_filename=None):
+    def __init__(
+        self,
+        host,
+        user="pi",
+        password=None,
+        key_filename=None,
+        via=None,
+        auth_order=None,
+    ):
         self.host = host
         self.user = user
         self.password = password
         self.key_filename = key_filename
+        # Auth methods to try, in order (see AUTH_METHODS)
+        self.auth_order = auth_order
+        # Jump host (another PiBridge) whose transport carries our connection
+        self.via = via
         self.client = None
         self.sftp = None
+        # Exception behind the most recent failed connect(), if any
+        self.last_error = None
+        self._tunnel_lock = threading.Lock()
 
-    def connect(self, timeout=5):
+    def connect(self, timeout=5, open_sftp=True):
+        # Reconnecting (e.g. a gateway whose transport dropped) replaces the client
+        self.close()
+        self.sftp = None
+        self.last_error = None
         self.client = paramiko.SSHClient()
         self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         try:
+            sock = None
+            if self.via:
+                sock = self.via.open_tunnel(self.host, 22, timeout=timeout)
             self.client.connect(
                 self.host,
                 username=self.user,
-                password=self.password,
-                key_filename=self.key_filename,
                 timeout=timeout,
+                sock=sock,
+                auth_strategy=PiAuthStrategy(
+                    self.user,
+                    self.host,
+                    password=self.password,
+                    key_filename=self.key_filename,
+                    order=self.auth_order,
+                ),
             )
-            self.sftp = self.client.open_sftp()
+            if open_sftp:
+                self.sftp = self.client.open_sftp()
             return True
         except paramiko.ssh_exception.BadHostKeyException as e:
             # Re-raise the exception to be handled by the caller
+            self.last_error = e
             raise e
-        except Exception:
+        except Exception as e:
+            self.last_error = e
             return False
 
     def close(self):
@@ -45,11 +275,120 @@ class PiBridge:
         if self.client:
             self.client.close()
 
-    def run(self, command):
+    def open_tunnel(self, host, port=22, timeout=5):
+        """
+        Open a direct-tcpip channel to host:port through this bridge's transport,
+        connecting it first if needed. The channel can be passed as sock= to
+        another SSH connection, so many Pis behind one gateway share a single
+        outer handshake.
+        """
+        with self._tunnel_lock:
+            # A gateway that failed once stays failed for the session, so the
+            # Pis behind it fail fast instead of each waiting out a timeout
+            if self.last_error:
+                raise self.last_error
+            transport = self.client.get_transport() if self.client else None
+            if not transport or not transport.is_active():
+                if not self.connect(timeout=timeout, open_sftp=False):
+                    if not self.last_error:
+                        self.last_error = RuntimeError(
+                            f"Could not connect to gateway {self.host}"
+                        )
+                    raise self.last_error
+                transport = self.client.get_transport()
+        return transport.open_channel(
+            "direct-tcpip", (host, port), ("127.0.0.1", 0), timeout=timeout
+        )
+
+    def exec_to(self, command, stdout_sink, stderr_sink, stdin_chunks=None):
+        """
+        Run a command, writing its stdout and stderr into binary file-like sinks.
+        Both streams are drained concurrently so a chatty stderr can't stall
+        the SSH window while we wait on stdout. If stdin_chunks is given, its
+        bytes are fed to the command's stdin from a background thread.
+        Returns the exit status.
+        """
         if not self.client:
             raise RuntimeError("Not connected. Call connect() first.")
+
         stdin, stdout, stderr = self.client.exec_command(command)
-        return stdout.read().decode(), stderr.read().decode()
+        channel = stdout.channel
+
+        feeder = None
+        if stdin_chunks is not None:
+            feeder = threading.Thread(
+                target=self._feed_stdin, args=(channel, stdin_chunks)
+            )
+            feeder.daemon = True
+            feeder.start()
+
+        while True:
+            # The channel's fileno is signalled for stdout, stderr and EOF alike
+            select.select([channel], [], [], 1.0)
+
+            while channel.recv_ready():
+                stdout_sink.write(channel.recv(RECV_CHUNK_SIZE))
+            while channel.recv_stderr_ready():
+                stderr_sink.write(channel.recv_stderr(RECV_CHUNK_SIZE))
+
+            if (
+                (channel.eof_received or channel.closed)
+                and not channel.recv_ready()
+                and not channel.recv_stderr_ready()
+            ):
+                break
+
+        exit_status = channel.recv_exit_status()
+        if feeder:
+            feeder.join()
+        return exit_status
+
+    @staticmethod
+    def _feed_stdin(channel, chunks):
+        try:
+            for chunk in chunks:
+                channel.sendall(chunk)
+        except (OSError, EOFError):
+            # The remote side stopped reading (e.g. sudo refused the password);
+            # the exit status and stderr tell the caller what went wrong.
+            pass
+        finally:
+            channel.shutdown_write()
+
+    def run_spooled(self, command, max_memory=DEFAULT_MAX_MEMORY):
+        """
+        Run a command and return (stdout, stderr, exit_status).
+        stdout and stderr are binary temporary files rewound to the start;
+        each keeps up to max_memory bytes in memory before spilling to disk.
+        The caller is responsible for closing them.
+        """
+        out = tempfile.SpooledTemporaryFile(max_size=max_memory, mode="w+b")
+        err = tempfile.SpooledTemporaryFile(max_size=max_memory, mode="w+b")
+        try:
+            exit_status = self.exec_to(command, out, err)
+        except Exception:
+            out.close()
+            err.close()
+            raise
+        out.seek(0)
+        err.seek(0)
+        return out, err, exit_status
+
+    def run(self, command, max_memory=DEFAULT_MAX_MEMORY):
+        """
+        Run a command and return (stdout, stderr, exit_status) with the output
+        decoded to strings. Use run_spooled() for commands with large output.
+        """
+        out, err, exit_status = self.run_spooled(command, max_memory=max_memory)
+        try:
+            return (
+                out.read().decode("utf-8", errors="replace"),
+                err.read().decode("utf-8", errors="replace"),
+                exit_status,
+            )
+        finally:
+            out.close()
+            err.close()
 
     def run_stream(self, command):
         """
@@ -119,6 +458,83 @@ class PiBridge:
             raise RuntimeError("Not connected. Call connect() first.")
         self.sftp.put(local_path, remote_path)
 
+    def upload_file_sudo(
+        self, local_path, remote_path, sudo_password=None, mode=None, owner=None
+    ):
+        """
+        Upload a file to a location that needs root, in a single exec round trip.
+        The file is streamed over the channel's stdin into a temporary file next
+        to the destination and renamed into place, so nothing is staged in /tmp
+        and every byte is written once. The parent directory is created, mode
+        and owner are applied, and the result is verified with sha256sum.
+        Without mode the file gets the remote umask (as an SFTP upload would),
+        and owner defaults to the connecting user. A leading ~ in remote_path
+        means the connecting user's home, not root's.
+        """
+        if not self.client:
+            raise RuntimeError("Not connected. Call connect() first.")
+
+        if owner is None:
+            owner = f"{self.user}:"
+
+        remote_path = str(remote_path)
+        remote_dir = os.path.dirname(remote_path) or "."
+        tmp_path = os.path.join(
+            remote_dir, f".{os.path.basename(remote_path)}.pi-shell"
+        )
+        steps = [
+            "set -e",
+            f"mkdir -p {sudo_shell_path(remote_dir)}",
+            # $$ keeps the name unique; noclobber refuses to reuse a file that
+            # already exists, and the redirect creates it with the umask's mode
+            f'tmp={sudo_shell_path(tmp_path)}."$$"',
+            "trap 'rm -f \"$tmp\"' EXIT",
+            'set -C; cat > "$tmp"; set +C',
+        ]
+        if mode is not None:
+            steps.append(f'chmod {shlex.quote(mode)} "$tmp"')
+        steps += [
+            f'chown {shlex.quote(owner)} "$tmp"',
+            f'mv -f "$tmp" {sudo_shell_path(remote_path)}',
+            f"sha256sum {sudo_shell_path(remote_path)}",
+        ]
+        script = "; ".join(steps)
+        # The SSH user's $HOME is passed in as $1 for ~ expansion
+        sudo_args = f'sh -c {shlex.quote(script)} pi-shell "$HOME"'
+        if sudo_password:
+            # The password goes over stdin ahead of the file data (never on the
+            # command line); `read` consumes exactly that line and `sudo -v`
+            # caches the credentials for the `sudo -n` that reads the rest.
+            command = (
+                "IFS= read -r pw && printf '%s\\n' \"$pw\" | sudo -S -p '' -v && "
+                f"sudo -n {sudo_args}"
+            )
+        else:
+            command = f"sudo {sudo_args}"
+
+        digest = hashlib.sha256()
+
+        def chunks():
+            if sudo_password:
+                yield sudo_password.encode() + b"\n"
+            with open(local_path, "rb") as f:
+                while True:
+                    chunk = f.read(RECV_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    yield chunk
+
+        out, err = io.BytesIO(), io.BytesIO()
+        exit_status = self.exec_to(command, out, err, stdin_chunks=chunks())
+        if exit_status != 0:
+            message = err.getvalue().decode("utf-8", errors="replace").strip()
+            raise RuntimeError(message or f"remote exit status {exit_status}")
+
+        remote_digest = out.getvalue().decode("utf-8", errors="replace").split()
+        if not remote_digest or remote_digest[0] != digest.hexdigest():
+            raise RuntimeError(f"Checksum mismatch after uploading to {remote_path}")
+
 
 def detect_pi_from_symlink():
     """
@@ -157,8 +573,9 @@ def load_config(config_path):
         # Create an empty config if it doesn't exist
         empty_config = {}
         save_config(config_path, empty_config)
-        print(f"Created empty config file at {config_path}")
-        print(f"Use 'pi-shell add' to add your first Pi.")
+        # Notes go to stderr so machine-readable output on stdout stays clean
+        print(f"Created empty config file at {config_path}", file=sys.stderr)
+        print(f"Use 'pi-shell add' to add your first Pi.", file=sys.stderr)
         return empty_config
     with open(cfg_file, "r") as f:
         return yaml.safe_load(f) or {}
@@ -173,6 +590,193 @@ def save_config(config_path, config):
         yaml.dump(config, f, default_flow_style=False)
 
 
+# Gateway bridges shared by every Pi that names them in `via:`, keyed by name
+_gateways = {}
+
+
+def get_gateway(config, via, _seen=()):
+    """
+    Return the shared PiBridge for a `via:` setting, or None if via is empty.
+    via is either the name of another config entry or an inline mapping with
+    host/user/key/password (and optionally its own via). Gateways are only
+    connected on first use and stay open until close_gateways() is called.
+    """
+    if not via:
+        return None
+
+    if isinstance(via, dict):
+        name = f"{via.get('user', 'pi')}@{via.get('host')}"
+        gw_config = via
+    else:
+        name = via
+        gw_config = config.get(via)
+        if not isinstance(gw_config, dict):
+            print(f"Error: Gateway '{via}' not found in config.", file=sys.stderr)
+            sys.exit(1)
+
+    if name in _seen:
+        print(f"Error: Gateway loop detected at '{name}'.", file=sys.stderr)
+        sys.exit(1)
+
+    if name not in _gateways:
+        key = gw_config.get("key")
+        if key and key.startswith("~"):
+            key = os.path.expanduser(key)
+        _gateways[name] = PiBridge(
+            host=gw_config.get("host"),
+            user=gw_config.get("user", "pi"),
+            password=gw_config.get("password"),
+            key_filename=key,
+            via=get_gateway(config, gw_config.get("via"), _seen + (name,)),
+            auth_order=gw_config.get("auth_order"),
+        )
+    return _gateways[name]
+
+
+def close_gateways():
+    for gateway in _gateways.values():
+        gateway.close()
+    _gateways.clear()
+
+
+def get_cache_dir():
+    return Path.home() / ".cache" / "pi-shell"
+
+
+def is_cacheable(pi_config, command):
+    """
+    True if command matches one of the Pi's `cache_commands` patterns.
+    Commands with shell metacharacters never match, so a pattern like
+    "uname *" can't let "uname -a; reboot" through.
+    """
+    if any(char in command for char in CACHE_UNSAFE_CHARS):
+        return False
+    patterns = pi_config.get("cache_commands") or []
+    return any(fnmatch.fnmatchcase(command, pattern) for pattern in patterns)
+
+
+def run_cached(bridge, pi_name, command, ttl, max_memory=DEFAULT_MAX_MEMORY):
+    """
+    Like bridge.run_spooled(), but serve the result from the on-disk cache when
+    the entry for (pi, host, user, command) is younger than ttl seconds. Each entry
+    has its own lock, so concurrent identical calls from any number of processes
+    wait for the one in-flight run and then reuse its result. The bridge is
+    only connected on a miss. Only exit status 0 results are stored, and only
+    if each stream fits in max_memory bytes.
+    Returns (stdout, stderr, exit_status, cached) with binary file objects
+    the caller must close.
+    """
+    cache_dir = get_cache_dir()
+    # Cached output is private to this user, like ~/.ssh
+    cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+    os.chmod(cache_dir, 0o700)
+    key = hashlib.sha256(
+        f"{pi_name}\0{bridge.host}\0{bridge.user}\0{command}".encode()
+    ).hexdigest()
+    entry_path = cache_dir / f"{key}.json"
+    stream_paths = (cache_dir / f"{key}.stdout", cache_dir / f"{key}.stderr")
+
+    with open(cache_dir / f"{key}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        try:
+            with open(entry_path, "r") as f:
+                entry = json.load(f)
+            if time.time() - entry["time"] < ttl:
+                out = open(stream_paths[0], "rb")
+                try:
+                    err = open(stream_paths[1], "rb")
+                except OSError:
+                    out.close()
+                    raise
+                return out, err, entry["exit_status"], True
+        except (OSError, ValueError, KeyError):
+            pass  # Missing or unreadable entry: treat as a miss
+
+        if not bridge.connect(open_sftp=False):
+            raise ConnectionError(f"Could not connect to {bridge.host}.")
+        out, err, exit_status = bridge.run_spooled(command, max_memory=max_memory)
+
+        sizes = []
+        for stream in (out, err):
+            stream.seek(0, os.SEEK_END)
+            sizes.append(stream.tell())
+        if exit_status == 0 and max(sizes) <= max_memory:
+            # Streams are copied as-is; the small metadata entry is written
+            # last, so an entry never points at incomplete output
+            for stream, path in zip((out, err), stream_paths):
+                stream.seek(0)
+                tmp_path = path.with_suffix(path.suffix + ".tmp")
+                with open(tmp_path, "wb") as f:
+                    shutil.copyfileobj(stream, f)
+                os.replace(tmp_path, path)
+            entry = {
+                "time": time.time(),
+                "pi": pi_name,
+                "user": bridge.user,
+                "command": command,
+                "exit_status": exit_status,
+            }
+            tmp_path = entry_path.with_suffix(".json.tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, entry_path)
+
+        out.seek(0)
+        err.seek(0)
+        return out, err, exit_status, False
+
+
+_emit_lock = threading.Lock()
+
+
+def emit_record(record):
+    """Print one NDJSON record, flushed so consumers can act on it right away."""
+    with _emit_lock:
+        print(json.dumps(record), flush=True)
+
+
+def fan_out(jobs, worker, parallel=DEFAULT_PARALLEL):
+    """
+    Run worker(*job) for each job on up to `parallel` threads, yielding results
+    in completion order so slow hosts don't hold back fast ones. Workers are
+    expected to report failures in their result rather than raise.
+    """
+    jobs = iter(jobs)
+    parallel = max(1, parallel)
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        # Jobs are submitted lazily, so at most `parallel` futures exist at once
+        pending = {
+            pool.submit(worker, *job) for job in itertools.islice(jobs, parallel)
+        }
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = next(jobs, None)
+                if job is not None:
+                    pending.add(pool.submit(worker, *job))
+                yield future.result()
+
+
+def new_record(name, host):
+    return {
+        "name": name,
+        "host": host,
+        "status": None,
+        "exit_code": None,
+        "connect_time": None,
+        "elapsed": None,
+        "bytes": 0,
+        "error": None,
+        "error_message": None,
+    }
+
+
+def record_error(record, error):
+    record["error"] = type(error).__name__
+    record["error_message"] = str(error)
+
+
 def get_pi_shell_key_path():
     """Get the path to the pi-shell SSH key"""
     return Path.home() / ".ssh" / "pi-shell"
@@ -250,7 +854,7 @@ def push_ssh_key_to_pi(host, user, password, key_path, timeout=30):
         bridge.run("chmod 600 ~/.ssh/authorized_keys")
 
         # Check if key already exists to avoid duplicates
-        out, _ = bridge.run(
+        out, _, _ = bridge.run(
             f'grep -F "{pub_key.split()[0]}" ~/.ssh/authorized_keys 2>/dev/null || echo "not_found"'
         )
 
@@ -324,8 +928,6 @@ def handle_add(args):
 
     # Create symlink to pi-shell command
     try:
-        import shutil
-
         pi_shell_path = shutil.which("pi-shell")
         if pi_shell_path:
             symlink_dir = Path(pi_shell_path).parent
@@ -378,10 +980,25 @@ def handle_list(args):
     pi_list = {k: v for k, v in config.items() if k != "default"}
 
     if not pi_list:
-        print("No Pis configured.")
-        print(
-            "Use 'pi-shell add <name> --host <host> --user <user> --password <password> [--push-key]' to add a Pi."
-        )
+        if args.format != "ndjson":
+            print("No Pis configured.")
+            print(
+                "Use 'pi-shell add <name> --host <host> --user <user> --password <password> [--push-key]' to add a Pi."
+            )
+        return
+
+    if args.format == "ndjson":
+        for name, pi_config in pi_list.items():
+            emit_record(
+                {
+                    "name": name,
+                    "host": pi_config.get("host"),
+                    "user": pi_config.get("user"),
+                    "default": name == default_pi,
+                    "default_path": pi_config.get("default_path"),
+                    "via": pi_config.get("via"),
+                }
+            )
         return
 
     print(
@@ -421,9 +1038,41 @@ def handle_set_path(args):
     print(f"Default path for '{args.name}' set to '{args.path}'")
 
 
+def status_record(name, host, bridge, timeout):
+    """Connect to one Pi and fetch its hostname, returning a result record."""
+    record = new_record(name, host)
+    record["status"] = "OFFLINE"
+    record["hostname"] = None
+    start = time.monotonic()
+    try:
+        if bridge.connect(timeout=timeout):
+            record["connect_time"] = round(time.monotonic() - start, 3)
+            record["status"] = "ONLINE"
+            try:
+                out, err, exit_code = bridge.run("hostname")
+                record["exit_code"] = exit_code
+                record["bytes"] = len(out.encode()) + len(err.encode())
+                if out:
+                    record["hostname"] = out.strip()
+            except Exception as e:
+                record_error(record, e)
+        elif bridge.last_error:
+            record_error(record, bridge.last_error)
+    except paramiko.ssh_exception.BadHostKeyException as e:
+        record["status"] = "BAD KEY"
+        record_error(record, e)
+    except Exception as e:
+        record_error(record, e)  # Keep status as OFFLINE
+    finally:
+        bridge.close()
+    record["elapsed"] = round(time.monotonic() - start, 3)
+    return record
+
+
 def handle_status(args):
     config_path = get_config_path(args)
     config = load_config(config_path)
+    ndjson = args.format == "ndjson"
 
     pi_to_check = []
     if args.name:
@@ -435,15 +1084,18 @@ def handle_status(args):
         pi_to_check = [k for k in config.keys() if k != "default"]
 
     if not pi_to_check:
-        print("No Pis configured.")
-        print(
-            "Use 'pi-shell add <name> --host <host> --user <user> --password <password> [--push-key]' to add a Pi."
-        )
+        if not ndjson:
+            print("No Pis configured.")
+            print(
+                "Use 'pi-shell add <name> --host <host> --user <user> --password <password> [--push-key]' to add a Pi."
+            )
         return
 
-    print(f"{ 'Name':<10} { 'Host':<20} { 'Hostname':<20} { 'Status':<10}")
-    print("=" * 60)
+    if not ndjson:
+        print(f"{ 'Name':<10} { 'Host':<20} { 'Hostname':<20} { 'Status':<10}")
+        print("=" * 60)
 
+    jobs = []
     for name in pi_to_check:
         pi_config = config[name]
         host = pi_config.get("host")
@@ -455,16 +1107,24 @@ def handle_status(args):
         if key and key.startswith("~"):
             key = os.path.expanduser(key)
 
-        remote_hostname = "N/A"
-        status = "OFFLINE"
-
         if not host:
-            print(
-                f"{name:<10} {host or 'N/A':<20} {remote_hostname:<20} {'OFFLINE (No host)':<10}"
-            )
+            if ndjson:
+                record = new_record(name, host)
+                record["status"] = "OFFLINE (No host)"
+                emit_record(record)
+            else:
+                print(
+                    f"{name:<10} {host or 'N/A':<20} {'N/A':<20} {'OFFLINE (No host)':<10}"
+                )
             continue
 
-        if not password and not key and os.getenv("PI_BRIDGE_NO_PROMPT") != "1":
+        # NDJSON output is for unattended use, so never stop to prompt there
+        if (
+            not password
+            and not key
+            and not ndjson
+            and os.getenv("PI_BRIDGE_NO_PROMPT") != "1"
+        ):
             try:
                 password = getpass.getpass(
                     f"Enter password for {user}@{host} (optional, for status check): "
@@ -472,24 +1132,48 @@ def handle_status(args):
             except (EOFError, KeyboardInterrupt):
                 password = None
 
-        bridge = PiBridge(host=host, user=user, password=password, key_filename=key)
+        bridge = PiBridge(
+            host=host,
+            user=user,
+            password=password,
+            key_filename=key,
+            via=get_gateway(config, pi_config.get("via")),
+            auth_order=pi_config.get("auth_order"),
+        )
+
+        if ndjson:
+            jobs.append((name, host, bridge, args.timeout))
+            continue
 
-        try:
-            if bridge.connect(timeout=args.timeout):
-                status = "ONLINE"
-                try:
-                    out, err = bridge.run("hostname")
-                    if out:
-                        remote_hostname = out.strip()
-                except Exception:
-                    pass
-        except paramiko.ssh_exception.BadHostKeyException:
-            status = "BAD KEY"
-        except Exception:
-            pass  # Keep status as OFFLINE
+        record = status_record(name, host, bridge, args.timeout)
+        remote_hostname = record["hostname"] or "N/A"
+        print(f"{name:<10} {host:<20} {remote_hostname:<20} {record['status']:<10}")
+
+    for record in fan_out(jobs, status_record, args.parallel):
+        emit_record(record)
 
-        print(f"{name:<10} {host:<20} {remote_hostname:<20} {status:<10}")
+
+def check_ssh_record(name, host, bridge, timeout=3):
+    """Non-interactive check-ssh for one Pi, returning a result record."""
+    record = new_record(name, host)
+    record["status"] = "OFFLINE"
+    start = time.monotonic()
+    try:
+        if bridge.connect(timeout=timeout):
+            record["connect_time"] = round(time.monotonic() - start, 3)
+            record["status"] = "OK"
+        elif bridge.last_error:
+            record_error(record, bridge.last_error)
+    except paramiko.ssh_exception.BadHostKeyException as e:
+        record["status"] = "BAD KEY"
+        record_error(record, e)
+    except Exception as e:
+        record["status"] = "ERROR"
+        record_error(record, e)
+    finally:
         bridge.close()
+    record["elapsed"] = round(time.monotonic() - start, 3)
+    return record
 
 
 def handle_check_ssh(args):
@@ -497,10 +1181,13 @@ def handle_check_ssh(args):
     config = load_config(config_path)
 
     pi_to_check = [k for k in config.keys() if k != "default"]
+    ndjson = args.format == "ndjson"
 
-    print(f"{ 'Name':<10} { 'Host':<20} { 'Status':<20}")
-    print("=" * 50)
+    if not ndjson:
+        print(f"{ 'Name':<10} { 'Host':<20} { 'Status':<20}")
+        print("=" * 50)
 
+    jobs = []
     for name in pi_to_check:
         pi_config = config[name]
         host = pi_config.get("host")
@@ -515,10 +1202,27 @@ def handle_check_ssh(args):
         status = "OFFLINE"
 
         if not host:
-            print(f"{name:<10} {host or 'N/A':<20} {'OFFLINE (No host)':<20}")
+            if ndjson:
+                record = new_record(name, host)
+                record["status"] = "OFFLINE (No host)"
+                emit_record(record)
+            else:
+                print(f"{name:<10} {host or 'N/A':<20} {'OFFLINE (No host)':<20}")
             continue
 
-        bridge = PiBridge(host=host, user=user, password=password, key_filename=key)
+        bridge = PiBridge(
+            host=host,
+            user=user,
+            password=password,
+            key_filename=key,
+            via=get_gateway(config, pi_config.get("via")),
+            auth_order=pi_config.get("auth_order"),
+        )
+
+        if ndjson:
+            # Host key changes are reported, not fixed: there is no one to ask
+            jobs.append((name, host, bridge))
+            continue
 
         try:
             if bridge.connect(timeout=3):
@@ -544,6 +1248,351 @@ def handle_check_ssh(args):
 
         print(f"{name:<10} {host:<20} {status:<20}")
 
+    for record in fan_out(jobs, check_ssh_record, args.parallel):
+        emit_record(record)
+
+
+def probe_ssh(host, timeout):
+    """
+    Probe port 22 on host. Returns None if nothing is listening, otherwise a
+    record with the SSH banner and host key fingerprint (or the error class if
+    the handshake failed). No authentication is attempted.
+    """
+    start = time.monotonic()
+    try:
+        sock = socket.create_connection((host, 22), timeout=timeout)
+    except OSError:
+        return None
+
+    record = {
+        "host": host,
+        "banner": None,
+        "key_type": None,
+        "fingerprint": None,
+        "elapsed": None,
+        "error": None,
+        "error_message": None,
+    }
+    transport = None
+    try:
+        transport = paramiko.Transport(sock)
+        transport.set_log_channel(PROBE_LOG_CHANNEL)
+        transport.banner_timeout = timeout
+        transport.start_client(timeout=timeout)
+        key = transport.get_remote_server_key()
+        record["key_type"] = key.get_name()
+        record["fingerprint"] = key.fingerprint
+    except Exception as e:
+        record_error(record, e)
+    finally:
+        if transport:
+            record["banner"] = transport.remote_version or None
+            transport.close()
+        else:
+            sock.close()
+    record["elapsed"] = round(time.monotonic() - start, 3)
+    return record
+
+
+def push_key_record(record, user, password, key_path, timeout):
+    record["key_pushed"] = push_ssh_key_to_pi(
+        record["host"], user, password, key_path, timeout=timeout
+    )
+    return record
+
+
+def push_keys(args, records):
+    """Push the pi-shell key to every discovered host in parallel."""
+    # Generate or get existing pi-shell key
+    key_path = generate_pi_shell_key()
+
+    # One password for every Pi, asked once up front
+    password_for_push = args.password
+    if not password_for_push:
+        try:
+            password_for_push = getpass.getpass(
+                f"Enter password for {args.user} on {len(records)} Pi(s) "
+                "(needed to push SSH key): "
+            )
+        except (EOFError, KeyboardInterrupt):
+            print("\nCancelled.", file=sys.stderr)
+            sys.exit(1)
+
+    jobs = [
+        (record, args.user, password_for_push, key_path, args.push_timeout)
+        for record in records
+    ]
+    return list(fan_out(jobs, push_key_record, args.parallel))
+
+
+def handle_discover(args):
+    config_path = get_config_path(args)
+    config = load_config(config_path)
+    ndjson = args.format == "ndjson"
+
+    try:
+        network = ipaddress.ip_network(args.cidr, strict=False)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if network.num_addresses > MAX_DISCOVER_ADDRESSES:
+        print(
+            f"Error: {network} has {network.num_addresses} addresses; discover "
+            f"scans at most {MAX_DISCOVER_ADDRESSES} (an IPv4 /16 or IPv6 /112).",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+    if not ndjson:
+        print(
+            f"Scanning {network.num_addresses} addresses in {network}...",
+            file=sys.stderr,
+        )
+
+    jobs = ((str(ip), args.timeout) for ip in network.hosts())
+    hits = []
+    for record in fan_out(jobs, probe_ssh, args.parallel):
+        if record is None:
+            continue
+        if args.match and args.match not in (record["banner"] or ""):
+            continue
+        hits.append(record)
+        if ndjson and not (args.add or args.push_key):
+            emit_record(record)
+
+    hits.sort(key=lambda record: ipaddress.ip_address(record["host"]))
+
+    if not ndjson:
+        print(f"{ 'Host':<16} { 'Banner':<40} {'Host Key':<60}")
+        print("=" * 116)
+        for record in hits:
+            banner = record["banner"] or "N/A"
+            host_key = (
+                f"{record['key_type']} {record['fingerprint']}"
+                if record["fingerprint"]
+                else f"ERROR: {record['error']}"
+            )
+            print(f"{record['host']:<16} {banner:<40} {host_key:<60}")
+        print(f"Found {len(hits)} SSH host(s).", file=sys.stderr)
+
+    if not (args.add or args.push_key):
+        return
+
+    def config_name(record):
+        return f"{args.prefix}-{record['host'].replace('.', '-').replace(':', '-')}"
+
+    def known_entries(config):
+        """Hosts and names already in config, so discover never overwrites them."""
+        names = {name for name in config if name != "default"}
+        hosts = {
+            pi_config.get("host")
+            for pi_config in config.values()
+            if isinstance(pi_config, dict)
+        }
+        return hosts, names
+
+    known_hosts, known_names = known_entries(config)
+    # Only register hosts that completed an SSH handshake
+    new_hits = []
+    for record in hits:
+        if not record["fingerprint"] or record["host"] in known_hosts:
+            continue
+        if config_name(record) in known_names:
+            print(
+                f"⚠️  Skipping {record['host']}: a Pi named "
+                f"'{config_name(record)}' already exists in config",
+                file=sys.stderr,
+            )
+            continue
+        new_hits.append(record)
+    if len(new_hits) < len(hits) and not ndjson:
+        print(
+            f"Skipping {len(hits) - len(new_hits)} host(s) already in config "
+            "or not speaking SSH.",
+            file=sys.stderr,
+        )
+
+    key_to_use = args.key
+    if args.push_key and new_hits:
+        # Keep stdout for records in NDJSON mode; progress messages go to stderr
+        with contextlib.redirect_stdout(sys.stderr if ndjson else sys.stdout):
+            new_hits = push_keys(args, new_hits)
+        key_to_use = str(get_pi_shell_key_path())
+
+    # Store key path as relative to home directory for portability
+    if key_to_use and key_to_use.startswith(str(Path.home())):
+        key_to_use = key_to_use.replace(str(Path.home()), "~", 1)
+
+    entries = {}
+    for record in new_hits:
+        record["added"] = None
+        if args.push_key and not record["key_pushed"] and not args.password:
+            print(
+                f"⚠️  Not adding {record['host']}: key push failed and no --password given",
+                file=sys.stderr,
+            )
+            continue
+        entry = {"host": record["host"], "user": args.user}
+        if key_to_use and record.get("key_pushed", True):
+            entry["key"] = key_to_use
+        elif args.password:
+            entry["password"] = args.password
+        entries[config_name(record)] = entry
+
+    # The scan and key pushes can take minutes; re-read the config so edits
+    # made meanwhile by another pi-shell process are merged, not overwritten
+    if entries:
+        config = load_config(config_path)
+        known_hosts, known_names = known_entries(config)
+
+    added = []
+    saved_password = False
+    for record in new_hits:
+        name = config_name(record)
+        entry = entries.get(name)
+        if entry is not None:
+            if name in known_names or entry["host"] in known_hosts:
+                print(
+                    f"⚠️  Not adding {record['host']}: '{name}' or its host was "
+                    "added to config during the scan",
+                    file=sys.stderr,
+                )
+            else:
+                config[name] = entry
+                record["added"] = name
+                added.append(name)
+                saved_password = saved_password or "password" in entry
+        if ndjson:
+            emit_record(record)
+
+    if not added:
+        return
+
+    if saved_password:
+        print("Warning: Saving password in plain text in config.yml.", file=sys.stderr)
+
+    # All new Pis are written in one go
+    save_config(config_path, config)
+    if not ndjson:
+        print(f"Added {len(added)} Pi(s) to {config_path}: {', '.join(added)}")
+
+
+def run_record(name, host, bridge, command, max_memory, cache_ttl=None):
+    """
+    Run a command on one Pi, returning a result record with its output.
+    If cache_ttl is set the command goes through run_cached().
+    """
+    record = new_record(name, host)
+    record["status"] = "OFFLINE"
+    record["cached"] = False
+    start = time.monotonic()
+    try:
+        if cache_ttl:
+            out, err, exit_code, record["cached"] = run_cached(
+                bridge, name, command, cache_ttl, max_memory=max_memory
+            )
+        elif bridge.connect(open_sftp=False):
+            record["connect_time"] = round(time.monotonic() - start, 3)
+            out, err, exit_code = bridge.run_spooled(command, max_memory=max_memory)
+        else:
+            out = None
+        if out is not None:
+            record["status"] = "OK"
+            try:
+                stdout, stderr = out.read(), err.read()
+            finally:
+                out.close()
+                err.close()
+            record["exit_code"] = exit_code
+            record["bytes"] = len(stdout) + len(stderr)
+            record["stdout"] = stdout.decode("utf-8", errors="replace")
+            record["stderr"] = stderr.decode("utf-8", errors="replace")
+        elif bridge.last_error:
+            record_error(record, bridge.last_error)
+    except paramiko.ssh_exception.BadHostKeyException as e:
+        record["status"] = "BAD KEY"
+        record_error(record, e)
+    except ConnectionError as e:
+        record_error(record, bridge.last_error or e)
+    except Exception as e:
+        record["status"] = "ERROR"
+        record_error(record, e)
+    finally:
+        bridge.close()
+    record["elapsed"] = round(time.monotonic() - start, 3)
+    return record
+
+
+def handle_run_ndjson(args, cfg):
+    """
+    `run --format ndjson`: run the command on every Pi named in --pi
+    (comma-separated) concurrently, emitting one record per Pi as it finishes.
+    Returns 0 if every Pi ran the command with exit status 0, else 1.
+    """
+    if args.pi:
+        names = [name.strip() for name in args.pi.split(",") if name.strip()]
+    else:
+        names = [detect_pi_from_symlink() or cfg.get("default")]
+
+    failed = False
+    jobs = []
+    for name in names:
+        pi_config = cfg.get(name) if name else None
+        host = args.host if args.host and len(names) == 1 else None
+        host = host or (pi_config or {}).get("host")
+        if not pi_config or not host:
+            record = new_record(name, host)
+            record["status"] = "ERROR"
+            record["error"] = "ConfigError"
+            record["error_message"] = f"No configuration found for Pi '{name}'"
+            emit_record(record)
+            failed = True
+            continue
+
+        key = args.key or pi_config.get("key")
+        # Expand ~ in key path for portability across users
+        if key and key.startswith("~"):
+            key = os.path.expanduser(key)
+
+        bridge = PiBridge(
+            host=host,
+            user=args.user or pi_config.get("user", "pi"),
+            password=args.password or pi_config.get("password"),
+            key_filename=key,
+            via=get_gateway(cfg, pi_config.get("via")),
+            auth_order=pi_config.get("auth_order"),
+        )
+        cache_ttl = None
+        if args.cache_ttl and is_cacheable(pi_config, args.target):
+            cache_ttl = args.cache_ttl
+        jobs.append((name, host, bridge, args.target, args.max_memory, cache_ttl))
+
+    for record in fan_out(jobs, run_record, args.parallel):
+        emit_record(record)
+        if record["exit_code"] != 0:
+            failed = True
+
+    return 1 if failed else 0
+
+
+def add_format_argument(parser):
+    parser.add_argument(
+        "--format",
+        choices=["text", "ndjson"],
+        default="text",
+        help="Output format; ndjson prints one JSON record per Pi as it completes",
+    )
+
+
+def add_parallel_argument(parser):
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=DEFAULT_PARALLEL,
+        help=f"Pis to contact at once with --format ndjson (default: {DEFAULT_PARALLEL})",
+    )
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -571,9 +1620,34 @@ def main():
             p.add_argument(
                 "--sudo",
                 action="store_true",
-                help="Use sudo to move the file to the final destination",
+                help="Use sudo to write the file at the final destination",
             )
             p.add_argument("--sudo-password", help="Sudo password for the remote user")
+            p.add_argument(
+                "--mode",
+                help="File mode for --sudo uploads, e.g. 644 (default: remote umask)",
+            )
+            p.add_argument(
+                "--owner",
+                help="Owner for --sudo uploads, e.g. root:root (default: SSH user)",
+            )
+        elif action == "run":
+            p.add_argument("target", help="Command to run")
+            p.add_argument(
+                "--max-memory",
+                type=int,
+                default=DEFAULT_MAX_MEMORY,
+                help="Bytes of output kept in memory per stream before spilling "
+                f"to a temporary file (default: {DEFAULT_MAX_MEMORY})",
+            )
+            p.add_argument(
+                "--cache-ttl",
+                type=float,
+                help="Reuse a cached result up to this many seconds old "
+                "(only for commands matching the Pi's cache_commands)",
+            )
+            add_format_argument(p)
+            add_parallel_argument(p)
         else:
             p.add_argument("target", help="Command to run or file path")
             if action == "write":
@@ -583,7 +1657,11 @@ def main():
                     help="Content for write action (optional if reading from stdin)",
                 )
 
-        p.add_argument("--pi", help="Specific Pi to use (e.g., pi1)")
+        p.add_argument(
+            "--pi",
+            help="Specific Pi to use (e.g., pi1); with run --format ndjson, a "
+            "comma-separated list (e.g., pi1,pi2)",
+        )
         p.add_argument("--host", help="Override Pi hostname or IP")
         p.add_argument("--user", help="Override SSH username")
         p.add_argument("--password", help="Override SSH password")
@@ -616,6 +1694,7 @@ def main():
     p_remove.set_defaults(func=handle_remove)
 
     p_list = subparsers.add_parser("list", help="List all configured Pis")
+    add_format_argument(p_list)
     p_list.set_defaults(func=handle_list)
 
     p_set_default = subparsers.add_parser("set-default", help="Set the default Pi")
@@ -636,22 +1715,84 @@ def main():
     p_status.add_argument(
         "--timeout", type=int, default=3, help="Connection timeout in seconds (default: 3)"
     )
+    add_format_argument(p_status)
+    add_parallel_argument(p_status)
     p_status.set_defaults(func=handle_status)
 
     p_check_ssh = subparsers.add_parser(
         "check-ssh", help="Check SSH host keys for all Pis"
     )
+    add_format_argument(p_check_ssh)
+    add_parallel_argument(p_check_ssh)
     p_check_ssh.set_defaults(func=handle_check_ssh)
 
+    p_discover = subparsers.add_parser(
+        "discover", help="Scan a network for SSH hosts and optionally add them"
+    )
+    p_discover.add_argument("cidr", help="Network to scan (e.g., 192.168.1.0/24)")
+    p_discover.add_argument(
+        "--timeout",
+        type=float,
+        default=1.0,
+        help="Connection timeout in seconds per address (default: 1)",
+    )
+    p_discover.add_argument(
+        "--parallel",
+        type=int,
+        default=DEFAULT_DISCOVER_PARALLEL,
+        help=f"Addresses to probe at once (default: {DEFAULT_DISCOVER_PARALLEL})",
+    )
+    p_discover.add_argument(
+        "--match", help="Only keep hosts whose SSH banner contains this text"
+    )
+    p_discover.add_argument(
+        "--add", action="store_true", help="Add the hosts found to the configuration"
+    )
+    p_discover.add_argument(
+        "--prefix",
+        default="pi",
+        help="Name prefix for added Pis, followed by the address (default: pi)",
+    )
+    p_discover.add_argument(
+        "--user", default="pi", help="SSH username for added Pis (default: pi)"
+    )
+    p_discover.add_argument(
+        "--password", help="SSH password (will be stored in plain text)"
+    )
+    p_discover.add_argument("--key", help="Path to SSH private key")
+    p_discover.add_argument(
+        "--push-key",
+        action="store_true",
+        help="Push the pi-shell SSH key to every host found (implies --add)",
+    )
+    p_discover.add_argument(
+        "--push-timeout",
+        type=int,
+        default=30,
+        help="Connection timeout in seconds for SSH key push (default: 30)",
+    )
+    add_format_argument(p_discover)
+    p_discover.set_defaults(func=handle_discover)
+
     args = parser.parse_args()
 
     if hasattr(args, "func"):
-        args.func(args)
+        try:
+            args.func(args)
+        finally:
+            close_gateways()
         sys.exit(0)
 
     config_path = get_config_path(args)
     cfg = load_config(config_path)
 
+    if args.action == "run" and args.format == "ndjson":
+        try:
+            exit_code = handle_run_ndjson(args, cfg)
+        finally:
+            close_gateways()
+        sys.exit(exit_code)
+
     pi_identifier = args.pi or detect_pi_from_symlink() or cfg.get("default")
 
     if not pi_identifier:
@@ -691,19 +1832,60 @@ def main():
             print("\nCancelled.", file=sys.stderr)
             sys.exit(1)
 
-    bridge = PiBridge(host=host, user=user, password=password, key_filename=key)
+    bridge = PiBridge(
+        host=host,
+        user=user,
+        password=password,
+        key_filename=key,
+        via=get_gateway(cfg, pi_config.get("via")),
+        auth_order=pi_config.get("auth_order"),
+    )
+
+    use_cache = False
+    if args.action == "run" and args.cache_ttl:
+        use_cache = is_cacheable(pi_config, args.target)
+        if not use_cache:
+            print(
+                f"Note: command is not in cache_commands for '{pi_identifier}'; "
+                "running uncached.",
+                file=sys.stderr,
+            )
 
     try:
-        if not bridge.connect():
+        # Cached runs only connect on a miss
+        if not use_cache and not bridge.connect():
             print(f"Error: Could not connect to {host}.", file=sys.stderr)
             sys.exit(1)
 
         if args.action == "run":
-            out, err = bridge.run(args.target)
-            if out:
-                print(out, end="")
-            if err:
-                print(err, end="", file=sys.stderr)
+            if use_cache:
+                try:
+                    out, err, exit_status, _ = run_cached(
+                        bridge,
+                        pi_identifier,
+                        args.target,
+                        args.cache_ttl,
+                        max_memory=args.max_memory,
+                    )
+                except ConnectionError as e:
+                    print(f"Error: {e}", file=sys.stderr)
+                    sys.exit(1)
+            else:
+                out, err, exit_status = bridge.run_spooled(
+                    args.target, max_memory=args.max_memory
+                )
+            try:
+                sys.stdout.flush()
+                shutil.copyfileobj(out, sys.stdout.buffer)
+                sys.stdout.buffer.flush()
+                sys.stderr.flush()
+                shutil.copyfileobj(err, sys.stderr.buffer)
+                sys.stderr.buffer.flush()
+            finally:
+                out.close()
+                err.close()
+            if exit_status != 0:
+                sys.exit(exit_status)
         elif args.action == "run-stream":
             exit_status = bridge.run_stream(args.target)
             if exit_status != 0:
@@ -744,37 +1926,31 @@ def main():
             remote_path = Path(remote_path_str)
             remote_dir = remote_path.parent
 
-            # Ensure remote directory exists
-            mkdir_cmd = f"mkdir -p {remote_dir}"
             if args.sudo:
-                if args.sudo_password:
-                    mkdir_cmd = f"echo '{args.sudo_password}' | sudo -S {mkdir_cmd}"
-                else:
-                    mkdir_cmd = f"sudo {mkdir_cmd}"
-
-            out, err = bridge.run(mkdir_cmd)
-            if err:
-                print(f"Error creating remote directory: {err}", file=sys.stderr)
-                sys.exit(1)
-
-            # Upload and move file
-            if args.sudo:
-                temp_path = f"/tmp/{local_path.name}"
-                print(f"Uploading {local_path.name} to {temp_path}...", file=sys.stderr)
-                bridge.upload_file(str(local_path), temp_path)
-
-                print(f"Moving file to {remote_path} with sudo...", file=sys.stderr)
-                if args.sudo_password:
-                    mv_command = f"echo '{args.sudo_password}' | sudo -S mv {temp_path} {str(remote_path)}"
-                else:
-                    mv_command = f"sudo mv {temp_path} {str(remote_path)}"
-
-                out, err = bridge.run(mv_command)
-                if err:
-                    print(f"Error moving file: {err}", file=sys.stderr)
-                else:
-                    print("File sent successfully.", file=sys.stderr)
+                # One exec channel: mkdir, write, chmod/chown and verify in place
+                print(
+                    f"Uploading {local_path.name} to {remote_path} with sudo...",
+                    file=sys.stderr,
+                )
+                try:
+                    bridge.upload_file_sudo(
+                        str(local_path),
+                        str(remote_path),
+                        sudo_password=args.sudo_password,
+                        mode=args.mode,
+                        owner=args.owner,
+                    )
+                except RuntimeError as e:
+                    print(f"Error uploading file: {e}", file=sys.stderr)
+                    sys.exit(1)
+                print("File sent successfully.", file=sys.stderr)
             else:
+                # Ensure remote directory exists
+                out, err, _ = bridge.run(f"mkdir -p {shlex.quote(str(remote_dir))}")
+                if err:
+                    print(f"Error creating remote directory: {err}", file=sys.stderr)
+                    sys.exit(1)
+
                 print(
                     f"Uploading {local_path.name} to {remote_path}...", file=sys.stderr
                 )
@@ -791,6 +1967,7 @@ def main():
         sys.exit(1)
     finally:
         bridge.close()
+        close_gateways()
 
 
 if __name__ == "__main__":